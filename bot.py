@@ -13,69 +13,131 @@ import sqlite3
 import logging
 import threading
 import re
+import selectors
+import signal
 import sys
 import atexit
 import requests
-
-# --- Flask Keep Alive Improvement ---
-from flask import Flask, request
-
-app = Flask('')
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from dataclasses import dataclass, field
+from typing import Callable
+
+try:
+    import orjson as json_lib  # Rust-backed parser, takes bytes directly
+except ImportError:
+    import json as json_lib
+
+# --- Keep Alive Web Server (aiohttp) ---
+import asyncio
+import contextlib
+import hmac
+import aiohttp
+from aiohttp import web
+
+try:
+    import uvloop  # libuv-based event loop; not available on Windows
+except ImportError:
+    uvloop = None
+
+routes = web.RouteTableDef()
 
 # Global variable to track last activity
 last_activity_time = time.time()  # 'time' already imported above
 WAKEUP_INTERVAL = 300  # 5 minutes
 
-@app.route('/')
-def home():
+# Render sets RENDER_EXTERNAL_URL for web services; the fallback is this bot's own deployment
+RENDER_URL = os.environ.get('RENDER_EXTERNAL_URL', "https://rs-clone-mhzw.onrender.com")
+WEBHOOK_PATH = "/webhook"
+# When set, Telegram echoes it in X-Telegram-Bot-Api-Secret-Token and other callers are rejected
+WEBHOOK_SECRET = os.environ.get('WEBHOOK_SECRET')
+
+@routes.get('/')
+async def home(request):
     global last_activity_time
     last_activity_time = time.time()
-    return "🤖 RS_HIST_BOT is running!\n📞 Webhook: /webhook\n👤 Owner: @RS_WONER\n⏰ Last active: " + time.ctime(last_activity_time)
+    return web.Response(text="🤖 RS_HIST_BOT is running!\n📞 Webhook: /webhook\n👤 Owner: @RS_WONER\n⏰ Last active: " + time.ctime(last_activity_time))
 
-@app.route('/webhook', methods=['POST'])
-def webhook():
+@routes.post(WEBHOOK_PATH)
+async def webhook(request):
     global last_activity_time
+    if WEBHOOK_SECRET and not hmac.compare_digest(
+            request.headers.get('X-Telegram-Bot-Api-Secret-Token', ''), WEBHOOK_SECRET):
+        return web.Response(text='Forbidden', status=403)
     last_activity_time = time.time()
-    
-    if request.headers.get('content-type') == 'application/json':
-        json_string = request.get_data().decode('utf-8')
-        update = telebot.types.Update.de_json(json_string)
-        bot.process_new_updates([update])  # ✅ 'bot' is global
-        return 'OK', 200
-    return 'Bad Request', 400
-
-@app.route('/ping')
-def ping():
+
+    if request.content_type == 'application/json':
+        payload = await request.read()
+        # Parsing and handler matching are synchronous; keep them off the event loop
+        await asyncio.to_thread(process_update_payload, payload)
+        return web.Response(text='OK')
+    return web.Response(text='Bad Request', status=400)
+
+def process_update_payload(payload):
+    update = telebot.types.Update.de_json(json_lib.loads(payload))
+    bot.process_new_updates([update])  # ✅ 'bot' is global
+
+@routes.get('/ping')
+async def ping(request):
     global last_activity_time
     last_activity_time = time.time()
-    return f"Pong! ✅ Bot is awake. Last activity: {time.ctime(last_activity_time)}"
+    return web.Response(text=f"Pong! ✅ Bot is awake. Last activity: {time.ctime(last_activity_time)}")
 
-@app.route('/status')
-def status():
+@routes.get('/status')
+async def status(request):
     global last_activity_time
     uptime = time.time() - last_activity_time
-    return f"""
+    return web.Response(text=f"""
     Bot Status:
     ✅ Running: Yes
     📅 Uptime: {uptime:.0f} seconds
     ⏰ Last Activity: {time.ctime(last_activity_time)}
     🔗 Webhook: /webhook
     🏓 Ping: /ping
-    """
+    """)
+
+@routes.get('/health')
+async def health(request):
+    """Cheap JSON liveness check for the hosting platform; does not count as activity"""
+    return json_response({'status': 'ok', 'running_scripts': len(bot_scripts)})
+
+def json_response(data, status=200):
+    """JSON response encoded with json_lib; orjson hands back bytes, stdlib json a str"""
+    body = json_lib.dumps(data)
+    if isinstance(body, str):
+        body = body.encode('utf-8')
+    return web.Response(body=body, status=status, content_type='application/json')
 
 # Auto-ping system to keep awake
-def auto_ping():
+async def auto_ping():
     """Automatically ping the server every 5 minutes to prevent sleep"""
-    while True:
-        time.sleep(WAKEUP_INTERVAL)
-        try:
-            # Ping own server to keep it awake
-            response = requests.get(f"https://rs-clone-mhzw.onrender.com/ping", timeout=10)
-            logger.info(f"🔄 Auto-ping sent. Status: {response.status_code}")
-        except Exception as e:
-            logger.error(f"⚠️ Auto-ping failed: {e}")
+    async with aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=10)) as session:
+        while True:
+            await asyncio.sleep(WAKEUP_INTERVAL)
+            if time.time() - last_activity_time < WAKEUP_INTERVAL:
+                continue  # webhook traffic already kept the instance awake
+            try:
+                # Ping own server to keep it awake
+                async with session.get(f"{RENDER_URL}/ping") as response:
+                    logger.info(f"🔄 Auto-ping sent. Status: {response.status}")
+            except Exception as e:
+                logger.error(f"⚠️ Auto-ping failed: {e}")
 
-# --- End Flask Keep Alive ---
+async def auto_ping_ctx(app):
+    """Run auto_ping on the server's event loop for the lifetime of the app"""
+    task = asyncio.create_task(auto_ping())
+    logger.info("🔄 Auto-ping task started (prevents 15min sleep)")
+    yield
+    task.cancel()
+    with contextlib.suppress(asyncio.CancelledError):
+        await task
+
+app = web.Application()
+app.add_routes(routes)
+app.cleanup_ctx.append(auto_ping_ctx)
+
+# --- End Keep Alive Web Server ---
 
 # --- Configuration ---
 TOKEN = os.environ.get('BOT_TOKEN')
@@ -96,6 +158,35 @@ SUBSCRIBED_USER_LIMIT = 30
 ADMIN_LIMIT = 999
 OWNER_LIMIT = float('inf')
 
+# Shared reply texts
+ADMIN_REQUIRED_MSG = "⚠️ Admin permissions required."
+NOT_AUTHORIZED_MSG = "⚠️ Not authorized."
+
+# Log viewer limits
+LOG_TAIL_LINES = 80
+TAIL_CHUNK_SIZE = 64 * 1024  # one read covers LOG_TAIL_LINES of typical output
+LOG_TAIL_MAX_BYTES = 256 * 1024
+MAX_LOG_MESSAGE_CHARS = 3900
+
+# Telegram rejects inline keyboards with more than 100 buttons; longer file lists are paged
+FILES_PER_PAGE = 90
+
+# Uploads are streamed to disk in 64 KB chunks; (connect, read) timeouts stop a stalled transfer
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+DOWNLOAD_TIMEOUT = (10, 60)  # connect / per-read
+DOWNLOAD_DEADLINE = 180  # seconds for the whole transfer
+
+# Script logs are appended through a raw fd that is closed in the parent right after spawn
+LOG_OPEN_FLAGS = os.O_WRONLY | os.O_CREAT | os.O_APPEND | getattr(os, 'O_CLOEXEC', 0)
+LOG_MAX_BYTES = 10 * 1024 * 1024  # rotate a script's log at start once it passes this size
+LOG_BACKUP_COUNT = 3
+
+# Non-interactive pip installs; quiet unless the output is streamed to the user
+PIP_INSTALL_FLAGS = ['--no-input', '--disable-pip-version-check']
+PIP_QUIET_FLAGS = ['--quiet']
+PIP_INSTALL_TIMEOUT = 300  # seconds for one requirements.txt install
+PIP_STATUS_INTERVAL = 2  # seconds between edits of the install progress message
+
 # Create necessary directories
 os.makedirs(UPLOAD_BOTS_DIR, exist_ok=True)
 os.makedirs(IROTECH_DIR, exist_ok=True)
@@ -104,9 +195,24 @@ os.makedirs(IROTECH_DIR, exist_ok=True)
 bot = telebot.TeleBot(TOKEN)
 
 # --- Data structures ---
-bot_scripts = {}
+@dataclass(slots=True)
+class ScriptInfo:
+    """A script launched by run_script(), as tracked in bot_scripts"""
+    process: subprocess.Popen
+    script_key: str
+    file_name: str = ''
+    script_owner_id: int = 0
+    chat_id: int = 0
+    user_folder: str = ''
+    file_type: str = 'py'
+    start_time: datetime = field(default_factory=datetime.now)
+
+bot_scripts = {}  # script_key -> ScriptInfo
+bot_scripts_lock = threading.RLock()  # Guards bot_scripts; callbacks, the reaper and cleanup all touch it
+bot_scripts_generation = 0  # bumped on every bot_scripts change so derived views know when to rebuild
 user_subscriptions = {}
 user_files = {}
+user_files_lock = threading.Lock()  # Guards read-modify-write of user_files lists across handler/launcher threads
 active_users = set()
 admin_ids = {ADMIN_ID, OWNER_ID}
 bot_locked = False
@@ -138,6 +244,8 @@ def init_db():
     try:
         conn = sqlite3.connect(DATABASE_PATH, check_same_thread=False)
         c = conn.cursor()
+        # WAL is stored in the DB file, so this only has to be set once
+        c.execute('PRAGMA journal_mode=WAL')
         c.execute('''CREATE TABLE IF NOT EXISTS subscriptions
                      (user_id INTEGER PRIMARY KEY, expiry TEXT)''')
         c.execute('''CREATE TABLE IF NOT EXISTS user_files
@@ -206,53 +314,187 @@ def get_user_file_limit(user_id):
 def get_user_file_count(user_id):
     return len(user_files.get(user_id, []))
 
+def get_user_status(user_id, remove_expired=False):
+    """Return the status label and subscription expiry line shown in the main menu"""
+    if user_id == OWNER_ID:
+        return "👑 Owner", ""
+    if user_id in admin_ids:
+        return "🛡️ Admin", ""
+    if user_id in user_subscriptions:
+        expiry_date = user_subscriptions[user_id].get('expiry')
+        if expiry_date and expiry_date > datetime.now():
+            days_left = (expiry_date - datetime.now()).days
+            return "⭐ Premium", f"\n⏳ Subscription expires in: {days_left} days"
+        if remove_expired:
+            remove_subscription_db(user_id)
+        return "🆓 Free User (Expired Sub)", ""
+    return "🆓 Free User", ""
+
+def get_user_level(user_id):
+    if user_id == OWNER_ID:
+        return "👑 Owner"
+    if user_id in admin_ids:
+        return "🛡️ Admin"
+    if user_id in user_subscriptions and user_subscriptions[user_id].get('expiry', datetime.min) > datetime.now():
+        return "⭐ Premium"
+    return "🆓 Free User"
+
+def tail_lines(path, n, max_bytes=LOG_TAIL_MAX_BYTES):
+    """Return the last n lines of a file, reading backwards from the end in chunks"""
+    lines = deque(maxlen=n)
+    with open(path, 'rb') as f:
+        remaining = f.seek(0, os.SEEK_END)
+        bytes_read = 0
+        partial = b''
+        first_chunk = True
+        while remaining > 0 and len(lines) < n and bytes_read < max_bytes:
+            bufsize = min(TAIL_CHUNK_SIZE, remaining)
+            remaining -= bufsize
+            f.seek(remaining)
+            chunk = f.read(bufsize)
+            bytes_read += bufsize
+            if first_chunk:
+                first_chunk = False
+                if chunk.endswith(b'\n'):
+                    chunk = chunk[:-1]
+            parts = (chunk + partial).split(b'\n')
+            partial = parts.pop(0)
+            for part in reversed(parts):
+                if len(lines) >= n:
+                    break
+                lines.appendleft(part.decode('utf-8', errors='ignore'))
+        if not first_chunk and len(lines) < n and (remaining == 0 or not lines):
+            lines.appendleft(partial.decode('utf-8', errors='ignore'))
+    return list(lines)
+
+@lru_cache(maxsize=64)
+def _cached_tail_lines(path, mtime_ns, size, n):
+    return tuple(tail_lines(path, n))
+
+def cached_tail_lines(path, n):
+    """tail_lines() memoized on the file's mtime and size, so an unchanged log is not re-read"""
+    st = os.stat(path)
+    return _cached_tail_lines(path, st.st_mtime_ns, st.st_size, n)
+
+# Shared so consecutive uploads reuse the pooled TLS connection to the file server
+download_session = requests.Session()
+
+class DownloadError(Exception):
+    """A file download failed; the message never contains the file URL, which embeds the token"""
+
+def download_telegram_file(tg_file_path, dest_path):
+    """Stream a Telegram file to dest_path in fixed-size chunks instead of holding it in memory"""
+    url = (telebot.apihelper.FILE_URL or "https://api.telegram.org/file/bot{0}/{1}").format(TOKEN, tg_file_path)
+    part_path = dest_path + '.part'
+    deadline = time.monotonic() + DOWNLOAD_DEADLINE
+    try:
+        try:
+            with download_session.get(url, stream=True, timeout=DOWNLOAD_TIMEOUT) as response:
+                if not response.ok:
+                    raise DownloadError(f"Download failed (HTTP {response.status_code})")
+                with open(part_path, 'wb') as f:
+                    for chunk in response.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
+                        f.write(chunk)
+                        if time.monotonic() > deadline:
+                            raise DownloadError(f"Download took longer than {DOWNLOAD_DEADLINE}s")
+        except requests.RequestException as e:
+            # requests puts the URL in its messages; report only the error type
+            raise DownloadError(f"Download failed ({type(e).__name__})") from None
+        os.replace(part_path, dest_path)
+    except BaseException:
+        with contextlib.suppress(OSError):
+            os.remove(part_path)
+        raise
+
+def rotate_log(path, max_bytes=LOG_MAX_BYTES, keep=LOG_BACKUP_COUNT):
+    """Shift path -> path.1 -> ... -> path.<keep> when path has grown past max_bytes"""
+    try:
+        if os.path.getsize(path) <= max_bytes:
+            return
+    except FileNotFoundError:
+        return
+    for i in range(keep - 1, 0, -1):
+        older = f"{path}.{i}"
+        if os.path.exists(older):
+            os.replace(older, f"{path}.{i + 1}")
+    os.replace(path, f"{path}.1")
+    logger.info(f"Rotated log {path}")
+
+def register_script(script_key, script_info):
+    global bot_scripts_generation
+    with bot_scripts_lock:
+        bot_scripts[script_key] = script_info
+        bot_scripts_generation += 1
+
+def forget_script(script_key, process=None):
+    """Drop a script entry; with process given, only if the entry still belongs to it"""
+    global bot_scripts_generation
+    with bot_scripts_lock:
+        script_info = bot_scripts.get(script_key)
+        if script_info is None or (process is not None and script_info.process is not process):
+            return None
+        bot_scripts_generation += 1
+        return bot_scripts.pop(script_key)
+
+def snapshot_scripts():
+    """Consistent copy of bot_scripts items to iterate without holding the lock"""
+    with bot_scripts_lock:
+        return tuple(bot_scripts.items())
+
+RUNNING_COUNTS_TTL = 30  # seconds; backstop in case an exit is never reaped
+_running_counts_cache = (-1, 0.0, {})  # (bot_scripts_generation, monotonic time built, {owner_id: running count})
+
+def running_script_counts():
+    """Running scripts per owner; re-checks processes after bot_scripts changes or the TTL lapses"""
+    global _running_counts_cache
+    with bot_scripts_lock:
+        generation = bot_scripts_generation
+        scripts = tuple(bot_scripts.items())
+    cached_generation, built_at, counts = _running_counts_cache
+    now = time.monotonic()
+    if cached_generation == generation and now - built_at < RUNNING_COUNTS_TTL:
+        return counts
+    counts = {}
+    for _, script_info in scripts:
+        owner_id = script_info.script_owner_id
+        if is_bot_running(owner_id, script_info.file_name):
+            counts[owner_id] = counts.get(owner_id, 0) + 1
+    # Dead entries dropped by is_bot_running() bump the generation, so the next call rebuilds
+    _running_counts_cache = (generation, now, counts)
+    return counts
+
 def is_bot_running(script_owner_id, file_name):
     script_key = f"{script_owner_id}_{file_name}"
     script_info = bot_scripts.get(script_key)
-    if script_info and script_info.get('process'):
+    if script_info and script_info.process:
         try:
-            proc = psutil.Process(script_info['process'].pid)
+            proc = psutil.Process(script_info.process.pid)
             is_running = proc.is_running() and proc.status() != psutil.STATUS_ZOMBIE
             if not is_running:
-                logger.warning(f"Process {script_info['process'].pid} for {script_key} found in memory but not running/zombie. Cleaning up.")
-                if 'log_file' in script_info and hasattr(script_info['log_file'], 'close') and not script_info['log_file'].closed:
-                    try:
-                        script_info['log_file'].close()
-                    except Exception as log_e:
-                        logger.error(f"Error closing log file during zombie cleanup {script_key}: {log_e}")
-                if script_key in bot_scripts:
-                    del bot_scripts[script_key]
+                logger.warning(f"Process {script_info.process.pid} for {script_key} found in memory but not running/zombie. Cleaning up.")
+                forget_script(script_key, script_info.process)
             return is_running
         except psutil.NoSuchProcess:
             logger.warning(f"Process for {script_key} not found (NoSuchProcess). Cleaning up.")
-            if 'log_file' in script_info and hasattr(script_info['log_file'], 'close') and not script_info['log_file'].closed:
-                try:
-                    script_info['log_file'].close()
-                except Exception as log_e:
-                    logger.error(f"Error closing log file during cleanup of non-existent process {script_key}: {log_e}")
-            if script_key in bot_scripts:
-                del bot_scripts[script_key]
+            forget_script(script_key, script_info.process)
             return False
         except Exception as e:
             logger.error(f"Error checking process status for {script_key}: {e}", exc_info=True)
             return False
     return False
 
+def close_process_stdin(process):
+    """Release the parent's end of a script's stdin pipe; it is never written to"""
+    if process and process.stdin and not process.stdin.closed:
+        with contextlib.suppress(OSError):
+            process.stdin.close()
+
 def kill_process_tree(process_info):
     pid = None
-    log_file_closed = False
-    script_key = process_info.get('script_key', 'N/A')
+    script_key = process_info.script_key
 
     try:
-        if 'log_file' in process_info and hasattr(process_info['log_file'], 'close') and not process_info['log_file'].closed:
-            try:
-                process_info['log_file'].close()
-                log_file_closed = True
-                logger.info(f"Closed log file for {script_key} (PID: {process_info.get('process', {}).get('pid', 'N/A')})")
-            except Exception as log_e:
-                logger.error(f"Error closing log file during kill for {script_key}: {log_e}")
-
-        process = process_info.get('process')
+        process = process_info.process
         if process and hasattr(process, 'pid'):
             pid = process.pid
             if pid:
@@ -304,15 +546,74 @@ def kill_process_tree(process_info):
 
                 except psutil.NoSuchProcess:
                     logger.warning(f"Process {pid or 'N/A'} for {script_key} not found during kill. Already terminated?")
+                finally:
+                    close_process_stdin(process)
             else:
                 logger.error(f"Process PID is None for {script_key}.")
-        elif log_file_closed:
-            logger.warning(f"Process object missing for {script_key}, but log file closed.")
         else:
-            logger.error(f"Process object missing for {script_key}, and no log file. Cannot kill.")
+            logger.error(f"Process object missing for {script_key}. Cannot kill.")
     except Exception as e:
         logger.error(f"❌ Unexpected error killing process tree for PID {pid or 'N/A'} ({script_key}): {e}", exc_info=True)
 
+# --- Child Process Reaper ---
+REAP_SWEEP_INTERVAL = 5  # seconds
+
+# pidfds (Linux 5.3+) become readable the moment a child exits; elsewhere fall back to a poll sweep
+_reaper_selector = selectors.DefaultSelector() if hasattr(os, 'pidfd_open') else None
+# Scripts without a pidfd (old kernel, seccomp, non-Linux): process -> script_key, polled every sweep
+_swept_processes = {}
+_swept_lock = threading.Lock()
+
+def watch_script_process(script_key, process):
+    if _reaper_selector is not None:
+        try:
+            pidfd = os.pidfd_open(process.pid)
+        except OSError as e:
+            logger.warning(f"pidfd_open failed for {script_key} (PID: {process.pid}): {e}. Relying on sweep.")
+        else:
+            _reaper_selector.register(pidfd, selectors.EVENT_READ, data=(script_key, process))
+            return
+    with _swept_lock:
+        _swept_processes[process] = script_key
+
+def _reap_script(script_key, process):
+    return_code = process.poll()
+    if return_code is None:
+        return False
+    close_process_stdin(process)
+    if forget_script(script_key, process):
+        logger.warning(f"Script {script_key} (PID: {process.pid}) exited with code {return_code}. Reaped.")
+    return True
+
+def _sweep_processes():
+    with _swept_lock:
+        swept = tuple(_swept_processes.items())
+    for process, script_key in swept:
+        if _reap_script(script_key, process):
+            with _swept_lock:
+                _swept_processes.pop(process, None)
+
+def _reaper_loop():
+    last_sweep = time.monotonic()
+    while True:
+        try:
+            if _reaper_selector is not None:
+                for key, _ in _reaper_selector.select(timeout=REAP_SWEEP_INTERVAL):
+                    _reaper_selector.unregister(key.fd)
+                    os.close(key.fd)
+                    _reap_script(*key.data)
+            else:
+                time.sleep(REAP_SWEEP_INTERVAL)
+            if time.monotonic() - last_sweep >= REAP_SWEEP_INTERVAL:
+                last_sweep = time.monotonic()
+                _sweep_processes()
+        except Exception as e:
+            logger.error(f"Error in process reaper: {e}", exc_info=True)
+            time.sleep(REAP_SWEEP_INTERVAL)
+
+threading.Thread(target=_reaper_loop, daemon=True, name='process-reaper').start()
+# --- End Child Process Reaper ---
+
 # --- Automatic Package Installation & Script Running ---
 def check_package_installed(package_name):
     """Check if a package is already installed"""
@@ -323,6 +624,13 @@ def check_package_installed(package_name):
     except Exception:
         return False
 
+def edit_status_message(status_msg, text):
+    """Best-effort edit of a progress message; a failed edit must not abort the work it reports on"""
+    try:
+        bot.edit_message_text(text, status_msg.chat.id, status_msg.message_id)
+    except Exception as e:  # API errors as well as network errors from requests
+        logger.warning(f"Could not edit status message: {e}")
+
 def install_missing_requirements(req_path, message):
     """Install only missing requirements from requirements.txt"""
     try:
@@ -344,25 +652,52 @@ def install_missing_requirements(req_path, message):
             bot.reply_to(message, f"✅ All packages already installed: {', '.join(installed_packages)}")
             return True
         
-        # Install only missing packages
-        bot.reply_to(message, f"🔄 Installing {len(missing_packages)} missing packages...")
-        
-        for package in missing_packages:
-            try:
-                command = [sys.executable, '-m', 'pip', 'install', package]
-                result = subprocess.run(command, capture_output=True, text=True, check=True, 
-                                      encoding='utf-8', errors='ignore', timeout=120)
-                logger.info(f"Installed {package}: {result.stdout}")
-            except subprocess.TimeoutExpired:
-                logger.error(f"Timeout installing {package}")
-                bot.reply_to(message, f"❌ Timeout installing {package}")
-                return False
-            except subprocess.CalledProcessError as e:
-                logger.error(f"Failed to install {package}: {e.stderr}")
-                bot.reply_to(message, f"❌ Failed to install {package}")
-                return False
-        
-        bot.reply_to(message, f"✅ Successfully installed {len(missing_packages)} packages")
+        # Install all missing packages in one pip run so dependencies are resolved once
+        status_text = f"🔄 Installing {len(missing_packages)} missing packages..."
+        status_msg = bot.reply_to(message, status_text)
+        command = [sys.executable, '-m', 'pip', 'install', *PIP_INSTALL_FLAGS, '--progress-bar', 'off', *missing_packages]
+        logger.info(f"Running install: {' '.join(command)}")
+        process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                                   text=True, encoding='utf-8', errors='ignore')
+        timed_out = threading.Event()
+
+        def kill_on_timeout():
+            timed_out.set()
+            process.kill()
+
+        timer = threading.Timer(PIP_INSTALL_TIMEOUT, kill_on_timeout)
+        timer.start()
+        output_tail = deque(maxlen=15)
+        last_edit = time.monotonic()
+        try:
+            for line in process.stdout:
+                line = line.rstrip()
+                if not line:
+                    continue
+                output_tail.append(line)
+                if time.monotonic() - last_edit >= PIP_STATUS_INTERVAL:
+                    last_edit = time.monotonic()
+                    edit_status_message(status_msg, f"{status_text}\n{line[:200]}")
+            return_code = process.wait()
+        finally:
+            timer.cancel()
+            if process.poll() is None:  # only when the loop above raised
+                process.kill()
+                process.wait()
+            process.stdout.close()
+
+        if timed_out.is_set():
+            logger.error(f"Timeout installing {missing_packages}")
+            edit_status_message(status_msg, f"❌ Timeout installing {len(missing_packages)} packages")
+            return False
+        if return_code != 0:
+            pip_log = "\n".join(output_tail)
+            logger.error(f"Failed to install {missing_packages}:\n{pip_log}")
+            edit_status_message(status_msg, f"❌ Failed to install packages:\n{pip_log[-3500:]}")
+            return False
+
+        logger.info(f"Installed {missing_packages}")
+        edit_status_message(status_msg, f"✅ Successfully installed {len(missing_packages)} packages")
         return True
         
     except Exception as e:
@@ -382,7 +717,7 @@ def attempt_install_pip(module_name, message):
         
     try:
         bot.reply_to(message, f"🐍 Module `{module_name}` not found. Installing `{package_name}`...", parse_mode='Markdown')
-        command = [sys.executable, '-m', 'pip', 'install', package_name]
+        command = [sys.executable, '-m', 'pip', 'install', *PIP_INSTALL_FLAGS, *PIP_QUIET_FLAGS, package_name]
         logger.info(f"Running install: {' '.join(command)}")
         result = subprocess.run(command, capture_output=True, text=True, check=False, encoding='utf-8', errors='ignore', timeout=120)
         if result.returncode == 0:
@@ -407,6 +742,25 @@ def attempt_install_pip(module_name, message):
         bot.reply_to(message, error_msg)
         return False
 
+# Bounded pool for bulk starts so "run all" overlaps the per-script pre-checks
+SCRIPT_LAUNCH_WORKERS = 16
+script_launcher = ThreadPoolExecutor(max_workers=SCRIPT_LAUNCH_WORKERS, thread_name_prefix='script-launcher')
+
+def log_launch_failure(future):
+    """Done-callback for script_launcher jobs; the executor would otherwise swallow the exception"""
+    exc = future.exception()
+    if exc is not None:
+        logger.error(f"Script launch job failed: {exc}", exc_info=exc)
+
+def kill_check_process(check_proc):
+    """Kill a pre-check run together with its process group and collect it"""
+    if os.name == 'nt':
+        check_proc.kill()
+    else:
+        with contextlib.suppress(ProcessLookupError):
+            os.killpg(check_proc.pid, signal.SIGKILL)
+    check_proc.communicate()
+
 def run_script(script_path, script_owner_id, user_folder, file_name, message_obj_for_reply, attempt=1):
     max_attempts = 2
     if attempt > max_attempts:
@@ -420,8 +774,6 @@ def run_script(script_path, script_owner_id, user_folder, file_name, message_obj
         if not os.path.exists(script_path):
             bot.reply_to(message_obj_for_reply, f"❌ Error: Script '{file_name}' not found at '{script_path}'!")
             logger.error(f"Script not found: {script_path} for user {script_owner_id}")
-            if script_owner_id in user_files:
-                user_files[script_owner_id] = [f for f in user_files.get(script_owner_id, []) if f[0] != file_name]
             remove_user_file_db(script_owner_id, file_name)
             return
 
@@ -430,8 +782,12 @@ def run_script(script_path, script_owner_id, user_folder, file_name, message_obj
             logger.info(f"Running Python pre-check: {' '.join(check_command)}")
             check_proc = None
             try:
-                check_proc = subprocess.Popen(check_command, cwd=user_folder, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True, encoding='utf-8', errors='ignore')
-                stdout, stderr = check_proc.communicate(timeout=10)
+                # Only stderr is inspected; discarding stdout saves a pipe and the copy into this process
+                # Own process group so a timeout also kills anything the script spawned;
+                # without it a grandchild holding stderr open would hang communicate()
+                check_proc = subprocess.Popen(check_command, cwd=user_folder, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE,
+                                              start_new_session=(os.name != 'nt'), text=True, encoding='utf-8', errors='ignore')
+                _, stderr = check_proc.communicate(timeout=10)
                 return_code = check_proc.returncode
                 logger.info(f"Python Pre-check early. RC: {return_code}. Stderr: {stderr[:200]}...")
                 if return_code != 0 and stderr:
@@ -455,8 +811,7 @@ def run_script(script_path, script_owner_id, user_folder, file_name, message_obj
             except subprocess.TimeoutExpired:
                 logger.info("Python Pre-check timed out (>10s), imports likely OK. Killing check process.")
                 if check_proc and check_proc.poll() is None:
-                    check_proc.kill()
-                    check_proc.communicate()
+                    kill_check_process(check_proc)
                 logger.info("Python Check process killed. Proceeding to long run.")
             except FileNotFoundError:
                 logger.error(f"Python interpreter not found: {sys.executable}")
@@ -469,15 +824,15 @@ def run_script(script_path, script_owner_id, user_folder, file_name, message_obj
             finally:
                 if check_proc and check_proc.poll() is None:
                     logger.warning(f"Python Check process {check_proc.pid} still running. Killing.")
-                    check_proc.kill()
-                    check_proc.communicate()
+                    kill_check_process(check_proc)
 
         logger.info(f"Starting long-running Python process for {script_key}")
         log_file_path = os.path.join(user_folder, f"{os.path.splitext(file_name)[0]}.log")
-        log_file = None
+        log_fd = None
         process = None
         try:
-            log_file = open(log_file_path, 'w', encoding='utf-8', errors='ignore')
+            rotate_log(log_file_path)
+            log_fd = os.open(log_file_path, LOG_OPEN_FLAGS, 0o644)
         except Exception as e:
             logger.error(f"Failed to open log file '{log_file_path}' for {script_key}: {e}", exc_info=True)
             bot.reply_to(message_obj_for_reply, f"❌ Failed to open log file '{log_file_path}': {e}")
@@ -490,44 +845,47 @@ def run_script(script_path, script_owner_id, user_folder, file_name, message_obj
                 startupinfo.dwFlags |= subprocess.STARTF_USESHOWWINDOW
                 startupinfo.wShowWindow = subprocess.SW_HIDE
             process = subprocess.Popen(
-                [sys.executable, script_path], cwd=user_folder, stdout=log_file, stderr=log_file,
+                [sys.executable, script_path], cwd=user_folder, stdout=log_fd, stderr=log_fd,
                 stdin=subprocess.PIPE, startupinfo=startupinfo, creationflags=creationflags,
+                start_new_session=(os.name != 'nt'), close_fds=True,
                 encoding='utf-8', errors='ignore'
             )
             logger.info(f"Started Python process {process.pid} for {script_key}")
-            bot_scripts[script_key] = {
-                'process': process, 'log_file': log_file, 'file_name': file_name,
-                'chat_id': message_obj_for_reply.chat.id,
-                'script_owner_id': script_owner_id,
-                'start_time': datetime.now(), 'user_folder': user_folder, 'type': 'py', 'script_key': script_key
-            }
-            bot.reply_to(message_obj_for_reply, f"✅ Python script '{file_name}' started! (PID: {process.pid}) (For User: {script_owner_id})")
+            register_script(script_key, ScriptInfo(
+                process=process, script_key=script_key, file_name=file_name,
+                script_owner_id=script_owner_id, chat_id=message_obj_for_reply.chat.id,
+                user_folder=user_folder, file_type='py'
+            ))
+            watch_script_process(script_key, process)
         except FileNotFoundError:
             logger.error(f"Python interpreter {sys.executable} not found for long run {script_key}")
             bot.reply_to(message_obj_for_reply, f"❌ Error: Python interpreter '{sys.executable}' not found.")
-            if log_file and not log_file.closed:
-                log_file.close()
-            if script_key in bot_scripts:
-                del bot_scripts[script_key]
+            forget_script(script_key)
         except Exception as e:
-            if log_file and not log_file.closed:
-                log_file.close()
             error_msg = f"❌ Error starting Python script '{file_name}': {str(e)}"
             logger.error(error_msg, exc_info=True)
             bot.reply_to(message_obj_for_reply, error_msg)
             if process and process.poll() is None:
                 logger.warning(f"Killing potentially started Python process {process.pid} for {script_key}")
-                kill_process_tree({'process': process, 'log_file': log_file, 'script_key': script_key})
-            if script_key in bot_scripts:
-                del bot_scripts[script_key]
+                kill_process_tree(ScriptInfo(process=process, script_key=script_key))
+            forget_script(script_key)
+        else:
+            # Kept out of the try above: a failed reply (e.g. 429 during run-all) must not kill the started script
+            try:
+                bot.reply_to(message_obj_for_reply, f"✅ Python script '{file_name}' started! (PID: {process.pid}) (For User: {script_owner_id})")
+            except Exception as e:
+                logger.warning(f"Could not confirm start of {script_key}: {e}")
+        finally:
+            # The child has its own copy of the descriptor; the parent never writes to it
+            os.close(log_fd)
     except Exception as e:
         error_msg = f"❌ Unexpected error running Python script '{file_name}': {str(e)}"
         logger.error(error_msg, exc_info=True)
         bot.reply_to(message_obj_for_reply, error_msg)
-        if script_key in bot_scripts:
+        script_info = forget_script(script_key)
+        if script_info:
             logger.warning(f"Cleaning up {script_key} due to error in run_script.")
-            kill_process_tree(bot_scripts[script_key])
-            del bot_scripts[script_key]
+            kill_process_tree(script_info)
 
 # --- Map Telegram import names to actual PyPI package names ---
 TELEGRAM_MODULES = {
@@ -605,116 +963,131 @@ TELEGRAM_MODULES = {
 
 # --- Database Operations ---
 DB_LOCK = threading.Lock()
-
-def save_user_file(user_id, file_name, file_type='py'):
+DB_FLUSH_DELAY = 0.5  # seconds to collect writes before committing them together
+
+_db_pending = {}  # row key -> (sql, params); a later write to the same row replaces the earlier one
+_db_pending_lock = threading.Lock()
+_db_dirty = threading.Event()
+_db_writer_conn = None  # long-lived connection used only under DB_LOCK
+
+def queue_db_write(row_key, sql, params):
+    """Queue a write for the background flusher instead of committing on the handler thread"""
+    with _db_pending_lock:
+        _db_pending.pop(row_key, None)  # re-insert so the row keeps its latest position
+        _db_pending[row_key] = (sql, params)
+    _db_dirty.set()
+
+def _get_db_writer_conn():
+    global _db_writer_conn
+    if _db_writer_conn is None:
+        _db_writer_conn = sqlite3.connect(DATABASE_PATH, check_same_thread=False)
+        # In WAL mode NORMAL skips the fsync on every commit; close_db() checkpoints on exit
+        _db_writer_conn.execute('PRAGMA synchronous=NORMAL')
+    return _db_writer_conn
+
+def flush_db_writes():
+    """Commit all queued writes in a single transaction"""
+    # Hold DB_LOCK while taking the batch so concurrent flushers commit batches in queue order
     with DB_LOCK:
-        conn = sqlite3.connect(DATABASE_PATH, check_same_thread=False)
-        c = conn.cursor()
+        with _db_pending_lock:
+            if not _db_pending:
+                return
+            pending = list(_db_pending.items())
+            _db_pending.clear()
         try:
-            c.execute('INSERT OR REPLACE INTO user_files (user_id, file_name, file_type) VALUES (?, ?, ?)',
-                      (user_id, file_name, file_type))
-            conn.commit()
-            if user_id not in user_files:
-                user_files[user_id] = []
-            user_files[user_id] = [(fn, ft) for fn, ft in user_files[user_id] if fn != file_name]
-            user_files[user_id].append((file_name, file_type))
-            logger.info(f"Saved file '{file_name}' ({file_type}) for user {user_id}")
+            conn = _get_db_writer_conn()
+            with conn:
+                for _, (sql, params) in pending:
+                    conn.execute(sql, params)
+            logger.info(f"Flushed {len(pending)} queued DB writes")
         except sqlite3.Error as e:
-            logger.error(f"❌ SQLite error saving file for user {user_id}, {file_name}: {e}")
+            logger.error(f"❌ SQLite error flushing {len(pending)} queued writes: {e}. Requeued.")
+            _requeue_db_writes(pending)
         except Exception as e:
-            logger.error(f"❌ Unexpected error saving file for {user_id}, {file_name}: {e}", exc_info=True)
-        finally:
-            conn.close()
-
-def remove_user_file_db(user_id, file_name):
+            logger.error(f"❌ Unexpected error flushing queued writes: {e}. Requeued.", exc_info=True)
+            _requeue_db_writes(pending)
+
+def _requeue_db_writes(writes):
+    """Put a failed batch back; memory already reflects it, but a newer queued write to a row wins"""
+    with _db_pending_lock:
+        for row_key, write in writes:
+            _db_pending.setdefault(row_key, write)
+    _db_dirty.set()
+
+def close_db():
+    """Flush queued writes and checkpoint the WAL so everything is durable before exit"""
+    global _db_writer_conn
+    flush_db_writes()
     with DB_LOCK:
-        conn = sqlite3.connect(DATABASE_PATH, check_same_thread=False)
-        c = conn.cursor()
+        if _db_writer_conn is None:
+            return
         try:
-            c.execute('DELETE FROM user_files WHERE user_id = ? AND file_name = ?', (user_id, file_name))
-            conn.commit()
-            if user_id in user_files:
-                user_files[user_id] = [f for f in user_files[user_id] if f[0] != file_name]
-                if not user_files[user_id]:
-                    del user_files[user_id]
-            logger.info(f"Removed file '{file_name}' for user {user_id} from DB")
+            _db_writer_conn.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+            logger.info("Database checkpointed for shutdown.")
         except sqlite3.Error as e:
-            logger.error(f"❌ SQLite error removing file for {user_id}, {file_name}: {e}")
-        except Exception as e:
-            logger.error(f"❌ Unexpected error removing file for {user_id}, {file_name}: {e}", exc_info=True)
+            logger.error(f"❌ SQLite error checkpointing database: {e}")
         finally:
-            conn.close()
+            _db_writer_conn.close()
+            _db_writer_conn = None
+
+def _db_flusher():
+    while True:
+        _db_dirty.wait()
+        time.sleep(DB_FLUSH_DELAY)
+        _db_dirty.clear()
+        flush_db_writes()
+
+def save_user_file(user_id, file_name, file_type='py'):
+    # Queue under the same lock so memory and the write queue agree on the last change to a row
+    with user_files_lock:
+        files = [(fn, ft) for fn, ft in user_files.get(user_id, []) if fn != file_name]
+        files.append((file_name, file_type))
+        user_files[user_id] = files
+        queue_db_write(('user_files', user_id, file_name),
+                       'INSERT OR REPLACE INTO user_files (user_id, file_name, file_type) VALUES (?, ?, ?)',
+                       (user_id, file_name, file_type))
+    logger.info(f"Saved file '{file_name}' ({file_type}) for user {user_id}")
+
+def remove_user_file_db(user_id, file_name):
+    with user_files_lock:
+        if user_id in user_files:
+            files = [f for f in user_files[user_id] if f[0] != file_name]
+            if files:
+                user_files[user_id] = files
+            else:
+                del user_files[user_id]
+        queue_db_write(('user_files', user_id, file_name),
+                       'DELETE FROM user_files WHERE user_id = ? AND file_name = ?', (user_id, file_name))
+    logger.info(f"Removed file '{file_name}' for user {user_id} from DB")
 
 def add_active_user(user_id):
     active_users.add(user_id)
-    with DB_LOCK:
-        conn = sqlite3.connect(DATABASE_PATH, check_same_thread=False)
-        c = conn.cursor()
-        try:
-            c.execute('INSERT OR IGNORE INTO active_users (user_id) VALUES (?)', (user_id,))
-            conn.commit()
-            logger.info(f"Added/Confirmed active user {user_id} in DB")
-        except sqlite3.Error as e:
-            logger.error(f"❌ SQLite error adding active user {user_id}: {e}")
-        except Exception as e:
-            logger.error(f"❌ Unexpected error adding active user {user_id}: {e}", exc_info=True)
-        finally:
-            conn.close()
+    queue_db_write(('active_users', user_id), 'INSERT OR IGNORE INTO active_users (user_id) VALUES (?)', (user_id,))
+    logger.info(f"Added/Confirmed active user {user_id} in DB")
 
 def save_subscription(user_id, expiry):
-    with DB_LOCK:
-        conn = sqlite3.connect(DATABASE_PATH, check_same_thread=False)
-        c = conn.cursor()
-        try:
-            expiry_str = expiry.isoformat()
-            c.execute('INSERT OR REPLACE INTO subscriptions (user_id, expiry) VALUES (?, ?)', (user_id, expiry_str))
-            conn.commit()
-            user_subscriptions[user_id] = {'expiry': expiry}
-            logger.info(f"Saved subscription for {user_id}, expiry {expiry_str}")
-        except sqlite3.Error as e:
-            logger.error(f"❌ SQLite error saving subscription for {user_id}: {e}")
-        except Exception as e:
-            logger.error(f"❌ Unexpected error saving subscription for {user_id}: {e}", exc_info=True)
-        finally:
-            conn.close()
+    expiry_str = expiry.isoformat()
+    user_subscriptions[user_id] = {'expiry': expiry}
+    queue_db_write(('subscriptions', user_id),
+                   'INSERT OR REPLACE INTO subscriptions (user_id, expiry) VALUES (?, ?)', (user_id, expiry_str))
+    logger.info(f"Saved subscription for {user_id}, expiry {expiry_str}")
 
 def remove_subscription_db(user_id):
-    with DB_LOCK:
-        conn = sqlite3.connect(DATABASE_PATH, check_same_thread=False)
-        c = conn.cursor()
-        try:
-            c.execute('DELETE FROM subscriptions WHERE user_id = ?', (user_id,))
-            conn.commit()
-            if user_id in user_subscriptions:
-                del user_subscriptions[user_id]
-            logger.info(f"Removed subscription for {user_id} from DB")
-        except sqlite3.Error as e:
-            logger.error(f"❌ SQLite error removing subscription for {user_id}: {e}")
-        except Exception as e:
-            logger.error(f"❌ Unexpected error removing subscription for {user_id}: {e}", exc_info=True)
-        finally:
-            conn.close()
+    if user_id in user_subscriptions:
+        del user_subscriptions[user_id]
+    queue_db_write(('subscriptions', user_id), 'DELETE FROM subscriptions WHERE user_id = ?', (user_id,))
+    logger.info(f"Removed subscription for {user_id} from DB")
 
 def add_admin_db(admin_id):
-    with DB_LOCK:
-        conn = sqlite3.connect(DATABASE_PATH, check_same_thread=False)
-        c = conn.cursor()
-        try:
-            c.execute('INSERT OR IGNORE INTO admins (user_id) VALUES (?)', (admin_id,))
-            conn.commit()
-            admin_ids.add(admin_id)
-            logger.info(f"Added admin {admin_id} to DB")
-        except sqlite3.Error as e:
-            logger.error(f"❌ SQLite error adding admin {admin_id}: {e}")
-        except Exception as e:
-            logger.error(f"❌ Unexpected error adding admin {admin_id}: {e}", exc_info=True)
-        finally:
-            conn.close()
+    admin_ids.add(admin_id)
+    queue_db_write(('admins', admin_id), 'INSERT OR IGNORE INTO admins (user_id) VALUES (?)', (admin_id,))
+    logger.info(f"Added admin {admin_id} to DB")
 
 def remove_admin_db(admin_id):
     if admin_id == OWNER_ID:
         logger.warning("Attempted to remove OWNER_ID from admins.")
         return False
+    flush_db_writes()  # the row may still be sitting in the write queue
     with DB_LOCK:
         conn = sqlite3.connect(DATABASE_PATH, check_same_thread=False)
         c = conn.cursor()
@@ -742,10 +1115,18 @@ def remove_admin_db(admin_id):
             return False
         finally:
             conn.close()
+
+threading.Thread(target=_db_flusher, daemon=True, name='db-flusher').start()
+atexit.register(close_db)
 # --- End Database Operations ---
 
 # --- Menu creation (Inline and ReplyKeyboards) ---
 def create_main_menu_inline(user_id):
+    return _build_main_menu_inline(user_id in admin_ids, bot_locked)
+
+@lru_cache(maxsize=None)
+def _build_main_menu_inline(is_admin, locked):
+    """Build the inline main menu once per (admin, lock state) combination"""
     markup = types.InlineKeyboardMarkup(row_width=2)
     buttons = [
         types.InlineKeyboardButton('📢 Updates Channel', url=UPDATE_CHANNEL),
@@ -755,12 +1136,12 @@ def create_main_menu_inline(user_id):
         types.InlineKeyboardButton('📞 Contact Owner', url=f'https://t.me/{YOUR_USERNAME.replace("@", "")}')
     ]
 
-    if user_id in admin_ids:
+    if is_admin:
         admin_buttons = [
             types.InlineKeyboardButton('💳 Subscriptions', callback_data='subscription'),
             types.InlineKeyboardButton('📊 Statistics', callback_data='stats'),
-            types.InlineKeyboardButton('🔒 Lock Bot' if not bot_locked else '🔓 Unlock Bot',
-                                     callback_data='lock_bot' if not bot_locked else 'unlock_bot'),
+            types.InlineKeyboardButton('🔒 Lock Bot' if not locked else '🔓 Unlock Bot',
+                                     callback_data='lock_bot' if not locked else 'unlock_bot'),
             types.InlineKeyboardButton('📢 Broadcast', callback_data='broadcast'),
             types.InlineKeyboardButton('👑 Admin Panel', callback_data='admin_panel'),
             types.InlineKeyboardButton('🟢 Run All User Scripts', callback_data='run_all_scripts')
@@ -780,13 +1161,15 @@ def create_main_menu_inline(user_id):
         markup.add(buttons[4])
     return markup
 
-def create_reply_keyboard_main_menu(user_id):
+def _build_reply_keyboard(layout):
     markup = types.ReplyKeyboardMarkup(resize_keyboard=True, row_width=2)
-    layout_to_use = ADMIN_COMMAND_BUTTONS_LAYOUT_USER_SPEC if user_id in admin_ids else COMMAND_BUTTONS_LAYOUT_USER_SPEC
-    for row_buttons_text in layout_to_use:
+    for row_buttons_text in layout:
         markup.add(*[types.KeyboardButton(text) for text in row_buttons_text])
     return markup
 
+def create_reply_keyboard_main_menu(user_id):
+    return ADMIN_REPLY_KEYBOARD if user_id in admin_ids else USER_REPLY_KEYBOARD
+
 def create_control_buttons(script_owner_id, file_name, is_running=True):
     markup = types.InlineKeyboardMarkup(row_width=2)
     if is_running:
@@ -809,6 +1192,26 @@ def create_control_buttons(script_owner_id, file_name, is_running=True):
     markup.add(types.InlineKeyboardButton("🔙 Back to Files", callback_data='check_files'))
     return markup
 
+def create_files_markup(user_id, user_files_list, page=0):
+    """One page of the file list keyboard, with Prev/Next buttons when the list spans several pages"""
+    files_sorted = sorted(user_files_list)
+    page_count = max(1, -(-len(files_sorted) // FILES_PER_PAGE))
+    page = min(max(page, 0), page_count - 1)  # the list may have shrunk since the button was sent
+    markup = types.InlineKeyboardMarkup(row_width=1)
+    for file_name, file_type in files_sorted[page * FILES_PER_PAGE:(page + 1) * FILES_PER_PAGE]:
+        is_running = is_bot_running(user_id, file_name)
+        status_icon = "🟢 Running" if is_running else "🔴 Stopped"
+        btn_text = f"{file_name} ({file_type}) - {status_icon}"
+        markup.add(types.InlineKeyboardButton(btn_text, callback_data=f'file_{user_id}_{file_name}'))
+    if page_count > 1:
+        nav_buttons = []
+        if page > 0:
+            nav_buttons.append(types.InlineKeyboardButton('⬅️ Prev', callback_data=f'files_page_{page - 1}'))
+        if page < page_count - 1:
+            nav_buttons.append(types.InlineKeyboardButton('Next ➡️', callback_data=f'files_page_{page + 1}'))
+        markup.row(*nav_buttons)
+    return markup
+
 def create_admin_panel():
     markup = types.InlineKeyboardMarkup(row_width=2)
     markup.row(
@@ -828,22 +1231,27 @@ def create_subscription_menu():
     markup.row(types.InlineKeyboardButton('🔍 Check Subscription', callback_data='check_subscription'))
     markup.row(types.InlineKeyboardButton('🔙 Back to Main', callback_data='back_to_main'))
     return markup
+
+# Static keyboards are built once and reused for every reply
+USER_REPLY_KEYBOARD = _build_reply_keyboard(COMMAND_BUTTONS_LAYOUT_USER_SPEC)
+ADMIN_REPLY_KEYBOARD = _build_reply_keyboard(ADMIN_COMMAND_BUTTONS_LAYOUT_USER_SPEC)
+ADMIN_PANEL_MARKUP = create_admin_panel()
+SUBSCRIPTION_MENU_MARKUP = create_subscription_menu()
+UPDATES_CHANNEL_MARKUP = types.InlineKeyboardMarkup()
+UPDATES_CHANNEL_MARKUP.add(types.InlineKeyboardButton('📢 Updates Channel', url=UPDATE_CHANNEL))
+CONTACT_OWNER_MARKUP = types.InlineKeyboardMarkup()
+CONTACT_OWNER_MARKUP.add(types.InlineKeyboardButton('📞 Contact Owner', url=f'https://t.me/{YOUR_USERNAME.replace("@", "")}'))
 # --- End Menu Creation ---
 
 # --- File Handling ---
-def handle_zip_file(downloaded_file_content, file_name_zip, message):
+def handle_zip_file(zip_path, file_name_zip, message):
+    """Extract and deploy a zip already downloaded into its own temp dir; the temp dir is removed afterwards"""
     user_id = message.from_user.id
     user_folder = get_user_folder(user_id)
-    temp_dir = None
+    temp_dir = os.path.dirname(zip_path)
     try:
-        temp_dir = tempfile.mkdtemp(prefix=f"user_{user_id}_zip_")
         logger.info(f"Temp dir for zip: {temp_dir}")
-        zip_path = os.path.join(temp_dir, file_name_zip)
-        
-        # Save zip file
-        with open(zip_path, 'wb') as new_file:
-            new_file.write(downloaded_file_content)
-            
+
         # Extract zip
         with zipfile.ZipFile(zip_path, 'r') as zip_ref:
             for member in zip_ref.infolist():
@@ -853,12 +1261,15 @@ def handle_zip_file(downloaded_file_content, file_name_zip, message):
             zip_ref.extractall(temp_dir)
             logger.info(f"Extracted zip to {temp_dir}")
 
-        extracted_items = os.listdir(temp_dir)
+        # scandir entries carry their file type, so no extra stat per item below
+        with os.scandir(temp_dir) as entries:
+            extracted_entries = list(entries)
+        extracted_items = [entry.name for entry in extracted_entries]
         logger.info(f"All extracted items: {extracted_items}")
         
         # Find all Python files
-        py_files = [f for f in extracted_items if f.endswith('.py')]
-        all_files = [f for f in extracted_items if os.path.isfile(os.path.join(temp_dir, f))]
+        py_files = {f for f in extracted_items if f.endswith('.py')}
+        all_files = [entry.name for entry in extracted_entries if entry.is_file()]
         
         # Handle requirements.txt - Install only missing packages
         req_file = 'requirements.txt' if 'requirements.txt' in extracted_items else None
@@ -883,7 +1294,7 @@ def handle_zip_file(downloaded_file_content, file_name_zip, message):
                 main_script_name = p
                 break
         if not main_script_name and py_files:
-            main_script_name = py_files[0]
+            main_script_name = min(py_files)
         if not main_script_name:
             bot.reply_to(message, "❌ No `.py` script found in archive!")
             return
@@ -893,22 +1304,24 @@ def handle_zip_file(downloaded_file_content, file_name_zip, message):
 
         # Move ALL extracted files to user folder
         moved_count = 0
-        for item_name in extracted_items:
-            src_path = os.path.join(temp_dir, item_name)
+        with os.scandir(user_folder) as entries:
+            existing_is_dir = {entry.name: entry.is_dir() for entry in entries}
+        for entry in extracted_entries:
+            item_name = entry.name
             dest_path = os.path.join(user_folder, item_name)
             
             # Remove existing files/folders
-            if os.path.exists(dest_path):
-                if os.path.isdir(dest_path):
+            if item_name in existing_is_dir:
+                if existing_is_dir[item_name]:
                     shutil.rmtree(dest_path)
                 else:
                     os.remove(dest_path)
             
             # Move to user folder
-            if os.path.isdir(src_path):
-                shutil.copytree(src_path, dest_path)
+            if entry.is_dir():
+                shutil.copytree(entry.path, dest_path)
             else:
-                shutil.copy2(src_path, dest_path)
+                shutil.copy2(entry.path, dest_path)
             moved_count += 1
             
         logger.info(f"Moved {moved_count} items to {user_folder}")
@@ -951,6 +1364,41 @@ def handle_py_file(file_path, script_owner_id, user_folder, file_name, message):
         bot.reply_to(message, f"❌ Error processing Python file: {str(e)}")
 # --- End File Handling ---
 
+# --- Pending Prompts (next-step replies with expiry) ---
+PROMPT_TTL = 600  # seconds a prompt waits for its reply
+
+@dataclass(slots=True)
+class PendingPrompt:
+    handler: Callable
+    created: float = field(default_factory=time.monotonic)
+
+pending_prompts = {}
+_prompts_lock = threading.Lock()
+
+def register_prompt(msg, handler):
+    """Route the next message in msg's chat to handler, unless it arrives after PROMPT_TTL"""
+    now = time.monotonic()
+    chat_id = msg.chat.id
+    with _prompts_lock:
+        expired = [c for c, p in pending_prompts.items() if now - p.created >= PROMPT_TTL]
+        for expired_chat_id in expired:
+            del pending_prompts[expired_chat_id]
+        pending_prompts[chat_id] = PendingPrompt(handler)
+    for expired_chat_id in expired:
+        bot.clear_step_handler_by_chat_id(expired_chat_id)
+    bot.clear_step_handler_by_chat_id(chat_id)
+    bot.register_next_step_handler(msg, _dispatch_prompt)
+
+def _dispatch_prompt(message):
+    with _prompts_lock:
+        prompt = pending_prompts.pop(message.chat.id, None)
+    if prompt is None or time.monotonic() - prompt.created >= PROMPT_TTL:
+        logger.info(f"Prompt for chat {message.chat.id} expired. Handling message normally.")
+        bot.process_new_messages([message])
+        return
+    prompt.handler(message)
+# --- End Pending Prompts ---
+
 # --- Logic Functions (called by commands and text handlers) ---
 def _logic_send_welcome(message):
     user_id = message.from_user.id
@@ -991,22 +1439,7 @@ def _logic_send_welcome(message):
     file_limit = get_user_file_limit(user_id)
     current_files = get_user_file_count(user_id)
     limit_str = str(file_limit) if file_limit != float('inf') else "Unlimited"
-    expiry_info = ""
-    if user_id == OWNER_ID:
-        user_status = "👑 Owner"
-    elif user_id in admin_ids:
-        user_status = "🛡️ Admin"
-    elif user_id in user_subscriptions:
-        expiry_date = user_subscriptions[user_id].get('expiry')
-        if expiry_date and expiry_date > datetime.now():
-            user_status = "⭐ Premium"
-            days_left = (expiry_date - datetime.now()).days
-            expiry_info = f"\n⏳ Subscription expires in: {days_left} days"
-        else:
-            user_status = "🆓 Free User (Expired Sub)"
-            remove_subscription_db(user_id)
-    else:
-        user_status = "🆓 Free User"
+    user_status, expiry_info = get_user_status(user_id, remove_expired=True)
 
     welcome_msg_text = (f"〽️ Welcome, {user_name}!\n\n🆔 Your User ID: `{user_id}`\n"
                         f"✳️ Username: `@{user_username or 'Not set'}`\n"
@@ -1028,9 +1461,7 @@ def _logic_send_welcome(message):
             logger.error(f"Fallback send_message failed for {user_id}: {fallback_e}")
 
 def _logic_updates_channel(message):
-    markup = types.InlineKeyboardMarkup()
-    markup.add(types.InlineKeyboardButton('📢 Updates Channel', url=UPDATE_CHANNEL))
-    bot.reply_to(message, "Visit our Updates Channel:", reply_markup=markup)
+    bot.reply_to(message, "Visit our Updates Channel:", reply_markup=UPDATES_CHANNEL_MARKUP)
 
 def _logic_upload_file(message):
     user_id = message.from_user.id
@@ -1052,12 +1483,7 @@ def _logic_check_files(message):
     if not user_files_list:
         bot.reply_to(message, "📂 Your files:\n\n(No files uploaded yet)")
         return
-    markup = types.InlineKeyboardMarkup(row_width=1)
-    for file_name, file_type in sorted(user_files_list):
-        is_running = is_bot_running(user_id, file_name)
-        status_icon = "🟢 Running" if is_running else "🔴 Stopped"
-        btn_text = f"{file_name} ({file_type}) - {status_icon}"
-        markup.add(types.InlineKeyboardButton(btn_text, callback_data=f'file_{user_id}_{file_name}'))
+    markup = create_files_markup(user_id, user_files_list)
     bot.reply_to(message, "📂 Your files:\nClick to manage.", reply_markup=markup, parse_mode='Markdown')
 
 def _logic_bot_speed(message):
@@ -1069,14 +1495,7 @@ def _logic_bot_speed(message):
         bot.send_chat_action(chat_id, 'typing')
         response_time = round((time.time() - start_time_ping) * 1000, 2)
         status = "🔓 Unlocked" if not bot_locked else "🔒 Locked"
-        if user_id == OWNER_ID:
-            user_level = "👑 Owner"
-        elif user_id in admin_ids:
-            user_level = "🛡️ Admin"
-        elif user_id in user_subscriptions and user_subscriptions[user_id].get('expiry', datetime.min) > datetime.now():
-            user_level = "⭐ Premium"
-        else:
-            user_level = "🆓 Free User"
+        user_level = get_user_level(user_id)
         speed_msg = (f"⚡ Bot Speed & Status:\n\n⏱️ API Response Time: {response_time} ms\n"
                      f"🚦 Bot Status: {status}\n"
                      f"👤 Your Level: {user_level}")
@@ -1086,31 +1505,23 @@ def _logic_bot_speed(message):
         bot.edit_message_text("❌ Error during speed test.", chat_id, wait_msg.message_id)
 
 def _logic_contact_owner(message):
-    markup = types.InlineKeyboardMarkup()
-    markup.add(types.InlineKeyboardButton('📞 Contact Owner', url=f'https://t.me/{YOUR_USERNAME.replace("@", "")}'))
-    bot.reply_to(message, "Click to contact Owner:", reply_markup=markup)
+    bot.reply_to(message, "Click to contact Owner:", reply_markup=CONTACT_OWNER_MARKUP)
 
 # --- Admin Logic Functions ---
 def _logic_subscriptions_panel(message):
     if message.from_user.id not in admin_ids:
-        bot.reply_to(message, "⚠️ Admin permissions required.")
+        bot.reply_to(message, ADMIN_REQUIRED_MSG)
         return
-    bot.reply_to(message, "💳 Subscription Management\nUse inline buttons from /start or admin command menu.", reply_markup=create_subscription_menu())
+    bot.reply_to(message, "💳 Subscription Management\nUse inline buttons from /start or admin command menu.", reply_markup=SUBSCRIPTION_MENU_MARKUP)
 
 def _logic_statistics(message):
     user_id = message.from_user.id
     total_users = len(active_users)
     total_files_records = sum(len(files) for files in user_files.values())
 
-    running_bots_count = 0
-    user_running_bots = 0
-
-    for script_key_iter, script_info_iter in list(bot_scripts.items()):
-        s_owner_id, _ = script_key_iter.split('_', 1)
-        if is_bot_running(int(s_owner_id), script_info_iter['file_name']):
-            running_bots_count += 1
-            if int(s_owner_id) == user_id:
-                user_running_bots += 1
+    running_counts = running_script_counts()
+    running_bots_count = sum(running_counts.values())
+    user_running_bots = running_counts.get(user_id, 0)
 
     stats_msg_base = (f"📊 Bot Statistics:\n\n"
                       f"👥 Total Users: {total_users}\n"
@@ -1128,14 +1539,14 @@ def _logic_statistics(message):
 
 def _logic_broadcast_init(message):
     if message.from_user.id not in admin_ids:
-        bot.reply_to(message, "⚠️ Admin permissions required.")
+        bot.reply_to(message, ADMIN_REQUIRED_MSG)
         return
     msg = bot.reply_to(message, "📢 Send message to broadcast to all active users.\n/cancel to abort.")
-    bot.register_next_step_handler(msg, process_broadcast_message)
+    register_prompt(msg, process_broadcast_message)
 
 def _logic_toggle_lock_bot(message):
     if message.from_user.id not in admin_ids:
-        bot.reply_to(message, "⚠️ Admin permissions required.")
+        bot.reply_to(message, ADMIN_REQUIRED_MSG)
         return
     global bot_locked
     bot_locked = not bot_locked
@@ -1145,10 +1556,10 @@ def _logic_toggle_lock_bot(message):
 
 def _logic_admin_panel(message):
     if message.from_user.id not in admin_ids:
-        bot.reply_to(message, "⚠️ Admin permissions required.")
+        bot.reply_to(message, ADMIN_REQUIRED_MSG)
         return
     bot.reply_to(message, "👑 Admin Panel\nManage admins. Use inline buttons from /start or admin menu.",
-                 reply_markup=create_admin_panel())
+                 reply_markup=ADMIN_PANEL_MARKUP)
 
 def _logic_run_all_scripts(message_or_call):
     if isinstance(message_or_call, telebot.types.Message):
@@ -1167,7 +1578,7 @@ def _logic_run_all_scripts(message_or_call):
         return
 
     if admin_user_id not in admin_ids:
-        reply_func("⚠️ Admin permissions required.")
+        reply_func(ADMIN_REQUIRED_MSG)
         return
 
     reply_func("⏳ Starting process to run all user scripts. This may take a while...")
@@ -1186,21 +1597,25 @@ def _logic_run_all_scripts(message_or_call):
         attempted_users += 1
         logger.info(f"Processing scripts for user {target_user_id}...")
         user_folder = get_user_folder(target_user_id)
+        # One directory read per user instead of a stat() per file
+        with os.scandir(user_folder) as entries:
+            present_files = {entry.name for entry in entries if entry.is_file()}
 
         for file_name, file_type in files_for_user:
             if not is_bot_running(target_user_id, file_name):
                 file_path = os.path.join(user_folder, file_name)
-                if os.path.exists(file_path):
+                if file_name in present_files:
                     logger.info(f"Admin {admin_user_id} attempting to start '{file_name}' ({file_type}) for user {target_user_id}.")
                     try:
                         if file_type == 'py':
-                            threading.Thread(target=run_script, args=(file_path, target_user_id, user_folder, file_name, admin_message_obj_for_script_runner)).start()
+                            script_launcher.submit(
+                                run_script, file_path, target_user_id, user_folder, file_name, admin_message_obj_for_script_runner
+                            ).add_done_callback(log_launch_failure)
                             started_count += 1
                         else:
                             logger.warning(f"Unknown file type '{file_type}' for {file_name} (user {target_user_id}). Skipping.")
                             error_files_details.append(f"`{file_name}` (User {target_user_id}) - Unknown type")
                             skipped_files += 1
-                        time.sleep(0.7)
                     except Exception as e:
                         logger.error(f"Error queueing start for '{file_name}' (user {target_user_id}): {e}")
                         error_files_details.append(f"`{file_name}` (User {target_user_id}) - Start error")
@@ -1210,17 +1625,18 @@ def _logic_run_all_scripts(message_or_call):
                     error_files_details.append(f"`{file_name}` (User {target_user_id}) - File not found")
                     skipped_files += 1
 
-    summary_msg = (f"✅ All Users' Scripts - Processing Complete:\n\n"
-                   f"▶️ Attempted to start: {started_count} scripts.\n"
-                   f"👥 Users processed: {attempted_users}.\n")
+    summary_parts = ["✅ All Users' Scripts - Processing Complete:\n",
+                     f"▶️ Attempted to start: {started_count} scripts.",
+                     f"👥 Users processed: {attempted_users}."]
     if skipped_files > 0:
-        summary_msg += f"⚠️ Skipped/Error files: {skipped_files}\n"
+        summary_parts.append(f"⚠️ Skipped/Error files: {skipped_files}")
         if error_files_details:
-            summary_msg += "Details (first 5):\n" + "\n".join([f"  - {err}" for err in error_files_details[:5]])
+            summary_parts.append("Details (first 5):")
+            summary_parts.extend(f"  - {err}" for err in error_files_details[:5])
             if len(error_files_details) > 5:
-                summary_msg += "\n  ... and more (check logs)."
+                summary_parts.append("  ... and more (check logs).")
 
-    reply_func(summary_msg, parse_mode='Markdown')
+    reply_func("\n".join(summary_parts), parse_mode='Markdown')
     logger.info(f"Run all scripts finished. Admin: {admin_user_id}. Started: {started_count}. Skipped/Errors: {skipped_files}")
 
 # --- Command Handlers & Text Handlers for ReplyKeyboard ---
@@ -1299,7 +1715,7 @@ def command_run_all_code(message):
     _logic_run_all_scripts(message)
 
 @bot.message_handler(commands=['ping'])
-def ping(message):
+def command_ping(message):
     start_ping_time = time.time()
     msg = bot.reply_to(message, "Pong!")
     latency = round((time.time() - start_ping_time) * 1000, 2)
@@ -1346,25 +1762,38 @@ def handle_file_upload_doc(message):
 
         download_wait_msg = bot.reply_to(message, f"⏳ Downloading `{file_name}`...")
         file_info_tg_doc = bot.get_file(doc.file_id)
-        downloaded_file_content = bot.download_file(file_info_tg_doc.file_path)
-        bot.edit_message_text(f"✅ Downloaded `{file_name}`. Processing...", chat_id, download_wait_msg.message_id)
-        logger.info(f"Downloaded {file_name} for user {user_id}")
         user_folder = get_user_folder(user_id)
 
+        temp_dir = None
         if file_ext == '.zip':
-            handle_zip_file(downloaded_file_content, file_name, message)
+            temp_dir = tempfile.mkdtemp(prefix=f"user_{user_id}_zip_")
+            dest_path = os.path.join(temp_dir, file_name)
         else:
-            file_path = os.path.join(user_folder, file_name)
-            with open(file_path, 'wb') as f:
-                f.write(downloaded_file_content)
-            logger.info(f"Saved single file to {file_path}")
-            handle_py_file(file_path, user_id, user_folder, file_name, message)
+            dest_path = os.path.join(user_folder, file_name)
+        # Until handle_zip_file() takes over the temp dir, any failure here must remove it
+        try:
+            download_telegram_file(file_info_tg_doc.file_path, dest_path)
+            edit_status_message(download_wait_msg, f"✅ Downloaded `{file_name}`. Processing...")
+            logger.info(f"Downloaded {file_name} for user {user_id} to {dest_path}")
+            if file_ext == '.zip':
+                # Extraction and pip installs can take minutes; keep the handler worker free
+                threading.Thread(target=handle_zip_file, args=(dest_path, file_name, message)).start()
+        except Exception:
+            if temp_dir:
+                shutil.rmtree(temp_dir, ignore_errors=True)
+            raise
+
+        if file_ext != '.zip':
+            handle_py_file(dest_path, user_id, user_folder, file_name, message)
     except telebot.apihelper.ApiTelegramException as e:
         logger.error(f"Telegram API Error handling file for {user_id}: {e}", exc_info=True)
         if "file is too big" in str(e).lower():
             bot.reply_to(message, f"❌ Telegram API Error: File too large to download (~20MB limit).")
         else:
             bot.reply_to(message, f"❌ Telegram API Error: {str(e)}. Try later.")
+    except DownloadError as e:
+        logger.error(f"Download error handling file for {user_id}: {e}")
+        bot.reply_to(message, f"❌ {e}. Try again.")
     except Exception as e:
         logger.error(f"❌ General error handling file for {user_id}: {e}", exc_info=True)
         bot.reply_to(message, f"❌ Unexpected error: {str(e)}")
@@ -1377,60 +1806,15 @@ def handle_callbacks(call):
     data = call.data
     logger.info(f"Callback: User={user_id}, Data='{data}'")
 
-    if bot_locked and user_id not in admin_ids and data not in ['back_to_main', 'speed', 'stats']:
+    if bot_locked and data not in LOCKED_ALLOWED_CALLBACKS and user_id not in admin_ids:
         bot.answer_callback_query(call.id, "⚠️ Bot locked by admin.", show_alert=True)
         return
     try:
-        if data == 'upload':
-            upload_callback(call)
-        elif data == 'check_files':
-            check_files_callback(call)
-        elif data.startswith('file_'):
-            file_control_callback(call)
-        elif data.startswith('start_'):
-            start_bot_callback(call)
-        elif data.startswith('stop_'):
-            stop_bot_callback(call)
-        elif data.startswith('restart_'):
-            restart_bot_callback(call)
-        elif data.startswith('delete_'):
-            delete_bot_callback(call)
-        elif data.startswith('logs_'):
-            logs_bot_callback(call)
-        elif data == 'speed':
-            speed_callback(call)
-        elif data == 'back_to_main':
-            back_to_main_callback(call)
-        elif data.startswith('confirm_broadcast_'):
-            handle_confirm_broadcast(call)
-        elif data == 'cancel_broadcast':
-            handle_cancel_broadcast(call)
-        elif data == 'subscription':
-            admin_required_callback(call, subscription_management_callback)
-        elif data == 'stats':
-            stats_callback(call)
-        elif data == 'lock_bot':
-            admin_required_callback(call, lock_bot_callback)
-        elif data == 'unlock_bot':
-            admin_required_callback(call, unlock_bot_callback)
-        elif data == 'run_all_scripts':
-            admin_required_callback(call, run_all_scripts_callback)
-        elif data == 'broadcast':
-            admin_required_callback(call, broadcast_init_callback)
-        elif data == 'admin_panel':
-            admin_required_callback(call, admin_panel_callback)
-        elif data == 'add_admin':
-            owner_required_callback(call, add_admin_init_callback)
-        elif data == 'remove_admin':
-            owner_required_callback(call, remove_admin_init_callback)
-        elif data == 'list_admins':
-            admin_required_callback(call, list_admins_callback)
-        elif data == 'add_subscription':
-            admin_required_callback(call, add_subscription_init_callback)
-        elif data == 'remove_subscription':
-            admin_required_callback(call, remove_subscription_init_callback)
-        elif data == 'check_subscription':
-            admin_required_callback(call, check_subscription_init_callback)
+        handler = CALLBACK_DISPATCH.get(data)
+        if handler is None:
+            handler = next((h for prefix, h in CALLBACK_PREFIX_DISPATCH if data.startswith(prefix)), None)
+        if handler:
+            handler(call)
         else:
             bot.answer_callback_query(call.id, "Unknown action.")
             logger.warning(f"Unhandled callback data: {data} from user {user_id}")
@@ -1443,7 +1827,7 @@ def handle_callbacks(call):
 
 def admin_required_callback(call, func_to_run):
     if call.from_user.id not in admin_ids:
-        bot.answer_callback_query(call.id, "⚠️ Admin permissions required.", show_alert=True)
+        bot.answer_callback_query(call.id, ADMIN_REQUIRED_MSG, show_alert=True)
         return
     func_to_run(call)
 
@@ -1464,7 +1848,7 @@ def upload_callback(call):
     bot.answer_callback_query(call.id)
     bot.send_message(call.message.chat.id, "📤 Send your Python (`.py`) or ZIP (`.zip`) file.")
 
-def check_files_callback(call):
+def check_files_callback(call, page=0):
     user_id = call.from_user.id
     chat_id = call.message.chat.id
     user_files_list = user_files.get(user_id, [])
@@ -1478,12 +1862,7 @@ def check_files_callback(call):
             logger.error(f"Error editing msg for empty file list: {e}")
         return
     bot.answer_callback_query(call.id)
-    markup = types.InlineKeyboardMarkup(row_width=1)
-    for file_name, file_type in sorted(user_files_list):
-        is_running = is_bot_running(user_id, file_name)
-        status_icon = "🟢 Running" if is_running else "🔴 Stopped"
-        btn_text = f"{file_name} ({file_type}) - {status_icon}"
-        markup.add(types.InlineKeyboardButton(btn_text, callback_data=f'file_{user_id}_{file_name}'))
+    markup = create_files_markup(user_id, user_files_list, page)
     markup.add(types.InlineKeyboardButton("🔙 Back to Main", callback_data='back_to_main'))
     try:
         bot.edit_message_text("📂 Your files:\nClick to manage.", chat_id, call.message.message_id, reply_markup=markup, parse_mode='Markdown')
@@ -1495,6 +1874,14 @@ def check_files_callback(call):
     except Exception as e:
         logger.error(f"Unexpected error editing msg for file list: {e}", exc_info=True)
 
+def files_page_callback(call):
+    try:
+        page = int(call.data[len('files_page_'):])
+    except ValueError:
+        bot.answer_callback_query(call.id, "Error: Invalid page.", show_alert=True)
+        return
+    check_files_callback(call, page)
+
 def file_control_callback(call):
     try:
         _, script_owner_id_str, file_name = call.data.split('_', 2)
@@ -1640,12 +2027,10 @@ def stop_bot_callback(call):
             return
 
         bot.answer_callback_query(call.id, f"⏳ Stopping {file_name} for user {script_owner_id}...")
-        process_info = bot_scripts.get(script_key)
+        process_info = forget_script(script_key)
         if process_info:
             kill_process_tree(process_info)
-            if script_key in bot_scripts:
-                del bot_scripts[script_key]
-                logger.info(f"Removed {script_key} from running after stop.")
+            logger.info(f"Removed {script_key} from running after stop.")
         else:
             logger.warning(f"Script {script_key} running by psutil but not in bot_scripts dict.")
 
@@ -1694,19 +2079,16 @@ def restart_bot_callback(call):
         if not os.path.exists(file_path):
             bot.answer_callback_query(call.id, f"⚠️ Error: File `{file_name}` missing! Re-upload.", show_alert=True)
             remove_user_file_db(script_owner_id, file_name)
-            if script_key in bot_scripts:
-                del bot_scripts[script_key]
+            forget_script(script_key)
             check_files_callback(call)
             return
 
         bot.answer_callback_query(call.id, f"⏳ Restarting {file_name} for user {script_owner_id}...")
         if is_bot_running(script_owner_id, file_name):
             logger.info(f"Restart: Stopping existing {script_key}...")
-            process_info = bot_scripts.get(script_key)
+            process_info = forget_script(script_key)
             if process_info:
                 kill_process_tree(process_info)
-            if script_key in bot_scripts:
-                del bot_scripts[script_key]
             time.sleep(1.5)
 
         logger.info(f"Restart: Starting script {script_key}...")
@@ -1763,29 +2145,30 @@ def delete_bot_callback(call):
         # Stop if running
         if is_bot_running(script_owner_id, file_name):
             logger.info(f"Delete: Stopping {script_key}...")
-            process_info = bot_scripts.get(script_key)
+            process_info = forget_script(script_key)
             if process_info:
                 kill_process_tree(process_info)
-            if script_key in bot_scripts:
-                del bot_scripts[script_key]
             time.sleep(0.5)
 
         user_folder = get_user_folder(script_owner_id)
         
         # Delete ALL files in user folder (complete cleanup)
         deleted_files = []
-        if os.path.exists(user_folder):
-            for item in os.listdir(user_folder):
-                item_path = os.path.join(user_folder, item)
-                try:
-                    if os.path.isdir(item_path):
-                        shutil.rmtree(item_path)
-                    else:
-                        os.remove(item_path)
-                    deleted_files.append(item)
-                    logger.info(f"Deleted: {item_path}")
-                except OSError as e:
-                    logger.error(f"Error deleting {item_path}: {e}")
+        try:
+            with os.scandir(user_folder) as entries:
+                folder_entries = list(entries)
+        except FileNotFoundError:
+            folder_entries = []
+        for entry in folder_entries:
+            try:
+                if entry.is_dir():
+                    shutil.rmtree(entry.path)
+                else:
+                    os.remove(entry.path)
+                deleted_files.append(entry.name)
+                logger.info(f"Deleted: {entry.path}")
+            except OSError as e:
+                logger.error(f"Error deleting {entry.path}: {e}")
 
         # Remove from database
         remove_user_file_db(script_owner_id, file_name)
@@ -1830,41 +2213,35 @@ def logs_bot_callback(call):
 
         user_folder = get_user_folder(script_owner_id)
         log_path = os.path.join(user_folder, f"{os.path.splitext(file_name)[0]}.log")
-        if not os.path.exists(log_path):
+        # The stat for the cache key doubles as the existence check
+        try:
+            log_lines = cached_tail_lines(log_path, LOG_TAIL_LINES)
+        except FileNotFoundError:
             bot.answer_callback_query(call.id, f"⚠️ No logs for '{file_name}'.", show_alert=True)
             return
+        except OSError as e:
+            logger.error(f"Error reading log {log_path}: {e}", exc_info=True)
+            bot.answer_callback_query(call.id, f"❌ Error reading log for '{file_name}'.", show_alert=True)
+            return
 
         bot.answer_callback_query(call.id)
         try:
-            log_content = ""
-            file_size = os.path.getsize(log_path)
-            max_log_kb = 100
-            max_tg_msg = 4096
-            if file_size == 0:
-                log_content = "(Log empty)"
-            elif file_size > max_log_kb * 1024:
-                with open(log_path, 'rb') as f:
-                    f.seek(-max_log_kb * 1024, os.SEEK_END)
-                    log_bytes = f.read()
-                log_content = log_bytes.decode('utf-8', errors='ignore')
-                log_content = f"(Last {max_log_kb} KB)\n...\n" + log_content
-            else:
-                with open(log_path, 'r', encoding='utf-8', errors='ignore') as f:
-                    log_content = f.read()
-
-            if len(log_content) > max_tg_msg:
-                log_content = log_content[-max_tg_msg:]
+            log_content = "\n".join(log_lines)
+            if len(log_content) > MAX_LOG_MESSAGE_CHARS:
+                log_content = log_content[-MAX_LOG_MESSAGE_CHARS:]
                 first_nl = log_content.find('\n')
                 if first_nl != -1:
                     log_content = "...\n" + log_content[first_nl + 1:]
                 else:
                     log_content = "...\n" + log_content
-            if not log_content.strip():
+            if not log_content:
+                log_content = "(Log empty)"
+            elif not log_content.strip():
                 log_content = "(No visible content)"
 
             bot.send_message(chat_id_for_reply, f"📜 Logs for `{file_name}` (User `{script_owner_id}`):\n```\n{log_content}\n```", parse_mode='Markdown')
         except Exception as e:
-            logger.error(f"Error reading/sending log {log_path}: {e}", exc_info=True)
+            logger.error(f"Error sending log {log_path}: {e}", exc_info=True)
             bot.send_message(chat_id_for_reply, f"❌ Error reading log for `{file_name}`.")
     except (ValueError, IndexError) as e:
         logger.error(f"Error parsing logs callback '{call.data}': {e}")
@@ -1882,14 +2259,7 @@ def speed_callback(call):
         bot.send_chat_action(chat_id, 'typing')
         response_time = round((time.time() - start_cb_ping_time) * 1000, 2)
         status = "🔓 Unlocked" if not bot_locked else "🔒 Locked"
-        if user_id == OWNER_ID:
-            user_level = "👑 Owner"
-        elif user_id in admin_ids:
-            user_level = "🛡️ Admin"
-        elif user_id in user_subscriptions and user_subscriptions[user_id].get('expiry', datetime.min) > datetime.now():
-            user_level = "⭐ Premium"
-        else:
-            user_level = "🆓 Free User"
+        user_level = get_user_level(user_id)
         speed_msg = (f"⚡ Bot Speed & Status:\n\n⏱️ API Response Time: {response_time} ms\n"
                      f"🚦 Bot Status: {status}\n"
                      f"👤 Your Level: {user_level}")
@@ -1909,21 +2279,7 @@ def back_to_main_callback(call):
     file_limit = get_user_file_limit(user_id)
     current_files = get_user_file_count(user_id)
     limit_str = str(file_limit) if file_limit != float('inf') else "Unlimited"
-    expiry_info = ""
-    if user_id == OWNER_ID:
-        user_status = "👑 Owner"
-    elif user_id in admin_ids:
-        user_status = "🛡️ Admin"
-    elif user_id in user_subscriptions:
-        expiry_date = user_subscriptions[user_id].get('expiry')
-        if expiry_date and expiry_date > datetime.now():
-            user_status = "⭐ Premium"
-            days_left = (expiry_date - datetime.now()).days
-            expiry_info = f"\n⏳ Subscription expires in: {days_left} days"
-        else:
-            user_status = "🆓 Free User (Expired Sub)"
-    else:
-        user_status = "🆓 Free User"
+    user_status, expiry_info = get_user_status(user_id)
     main_menu_text = (f"〽️ Welcome back, {call.from_user.first_name}!\n\n🆔 ID: `{user_id}`\n"
                       f"🔰 Status: {user_status}{expiry_info}\n📁 Files: {current_files} / {limit_str}\n\n"
                       f"👇 Use buttons or type commands.")
@@ -1944,7 +2300,7 @@ def subscription_management_callback(call):
     bot.answer_callback_query(call.id)
     try:
         bot.edit_message_text("💳 Subscription Management\nSelect action:",
-                              call.message.chat.id, call.message.message_id, reply_markup=create_subscription_menu())
+                              call.message.chat.id, call.message.message_id, reply_markup=SUBSCRIPTION_MENU_MARKUP)
     except Exception as e:
         logger.error(f"Error showing sub menu: {e}")
 
@@ -1983,12 +2339,12 @@ def run_all_scripts_callback(call):
 def broadcast_init_callback(call):
     bot.answer_callback_query(call.id)
     msg = bot.send_message(call.message.chat.id, "📢 Send message to broadcast.\n/cancel to abort.")
-    bot.register_next_step_handler(msg, process_broadcast_message)
+    register_prompt(msg, process_broadcast_message)
 
 def process_broadcast_message(message):
     user_id = message.from_user.id
     if user_id not in admin_ids:
-        bot.reply_to(message, "⚠️ Not authorized.")
+        bot.reply_to(message, NOT_AUTHORIZED_MSG)
         return
     if message.text and message.text.lower() == '/cancel':
         bot.reply_to(message, "Broadcast cancelled.")
@@ -1998,7 +2354,7 @@ def process_broadcast_message(message):
     if not broadcast_content and not (message.photo or message.video or message.document or message.sticker or message.voice or message.audio):
         bot.reply_to(message, "⚠️ Cannot broadcast empty message. Send text or media, or /cancel.")
         msg = bot.send_message(message.chat.id, "📢 Send broadcast message or /cancel.")
-        bot.register_next_step_handler(msg, process_broadcast_message)
+        register_prompt(msg, process_broadcast_message)
         return
 
     target_count = len(active_users)
@@ -2127,14 +2483,14 @@ def admin_panel_callback(call):
     bot.answer_callback_query(call.id)
     try:
         bot.edit_message_text("👑 Admin Panel\nManage admins (Owner actions may be restricted).",
-                              call.message.chat.id, call.message.message_id, reply_markup=create_admin_panel())
+                              call.message.chat.id, call.message.message_id, reply_markup=ADMIN_PANEL_MARKUP)
     except Exception as e:
         logger.error(f"Error showing admin panel: {e}")
 
 def add_admin_init_callback(call):
     bot.answer_callback_query(call.id)
     msg = bot.send_message(call.message.chat.id, "👑 Enter User ID to promote to Admin.\n/cancel to abort.")
-    bot.register_next_step_handler(msg, process_add_admin_id)
+    register_prompt(msg, process_add_admin_id)
 
 def process_add_admin_id(message):
     owner_id_check = message.from_user.id
@@ -2164,7 +2520,7 @@ def process_add_admin_id(message):
     except ValueError:
         bot.reply_to(message, "⚠️ Invalid ID. Send numerical ID or /cancel.")
         msg = bot.send_message(message.chat.id, "👑 Enter User ID to promote or /cancel.")
-        bot.register_next_step_handler(msg, process_add_admin_id)
+        register_prompt(msg, process_add_admin_id)
     except Exception as e:
         logger.error(f"Error processing add admin: {e}", exc_info=True)
         bot.reply_to(message, "Error.")
@@ -2172,7 +2528,7 @@ def process_add_admin_id(message):
 def remove_admin_init_callback(call):
     bot.answer_callback_query(call.id)
     msg = bot.send_message(call.message.chat.id, "👑 Enter User ID of Admin to remove.\n/cancel to abort.")
-    bot.register_next_step_handler(msg, process_remove_admin_id)
+    register_prompt(msg, process_remove_admin_id)
 
 def process_remove_admin_id(message):
     owner_id_check = message.from_user.id
@@ -2204,7 +2560,7 @@ def process_remove_admin_id(message):
     except ValueError:
         bot.reply_to(message, "⚠️ Invalid ID. Send numerical ID or /cancel.")
         msg = bot.send_message(message.chat.id, "👑 Enter Admin ID to remove or /cancel.")
-        bot.register_next_step_handler(msg, process_remove_admin_id)
+        register_prompt(msg, process_remove_admin_id)
     except Exception as e:
         logger.error(f"Error processing remove admin: {e}", exc_info=True)
         bot.reply_to(message, "Error.")
@@ -2216,19 +2572,19 @@ def list_admins_callback(call):
         if not admin_list_str:
             admin_list_str = "(No Owner/Admins configured!)"
         bot.edit_message_text(f"👑 Current Admins:\n\n{admin_list_str}", call.message.chat.id,
-                              call.message.message_id, reply_markup=create_admin_panel(), parse_mode='Markdown')
+                              call.message.message_id, reply_markup=ADMIN_PANEL_MARKUP, parse_mode='Markdown')
     except Exception as e:
         logger.error(f"Error listing admins: {e}")
 
 def add_subscription_init_callback(call):
     bot.answer_callback_query(call.id)
     msg = bot.send_message(call.message.chat.id, "💳 Enter User ID & days (e.g., `12345678 30`).\n/cancel to abort.")
-    bot.register_next_step_handler(msg, process_add_subscription_details)
+    register_prompt(msg, process_add_subscription_details)
 
 def process_add_subscription_details(message):
     admin_id_check = message.from_user.id
     if admin_id_check not in admin_ids:
-        bot.reply_to(message, "⚠️ Not authorized.")
+        bot.reply_to(message, NOT_AUTHORIZED_MSG)
         return
     if message.text.lower() == '/cancel':
         bot.reply_to(message, "Sub add cancelled.")
@@ -2258,7 +2614,7 @@ def process_add_subscription_details(message):
     except ValueError as e:
         bot.reply_to(message, f"⚠️ Invalid: {e}. Format: `ID days` or /cancel.")
         msg = bot.send_message(message.chat.id, "💳 Enter User ID & days, or /cancel.")
-        bot.register_next_step_handler(msg, process_add_subscription_details)
+        register_prompt(msg, process_add_subscription_details)
     except Exception as e:
         logger.error(f"Error processing add sub: {e}", exc_info=True)
         bot.reply_to(message, "Error.")
@@ -2266,12 +2622,12 @@ def process_add_subscription_details(message):
 def remove_subscription_init_callback(call):
     bot.answer_callback_query(call.id)
     msg = bot.send_message(call.message.chat.id, "💳 Enter User ID to remove sub.\n/cancel to abort.")
-    bot.register_next_step_handler(msg, process_remove_subscription_id)
+    register_prompt(msg, process_remove_subscription_id)
 
 def process_remove_subscription_id(message):
     admin_id_check = message.from_user.id
     if admin_id_check not in admin_ids:
-        bot.reply_to(message, "⚠️ Not authorized.")
+        bot.reply_to(message, NOT_AUTHORIZED_MSG)
         return
     if message.text.lower() == '/cancel':
         bot.reply_to(message, "Sub removal cancelled.")
@@ -2293,7 +2649,7 @@ def process_remove_subscription_id(message):
     except ValueError:
         bot.reply_to(message, "⚠️ Invalid ID. Send numerical ID or /cancel.")
         msg = bot.send_message(message.chat.id, "💳 Enter User ID to remove sub from, or /cancel.")
-        bot.register_next_step_handler(msg, process_remove_subscription_id)
+        register_prompt(msg, process_remove_subscription_id)
     except Exception as e:
         logger.error(f"Error processing remove sub: {e}", exc_info=True)
         bot.reply_to(message, "Error.")
@@ -2301,12 +2657,12 @@ def process_remove_subscription_id(message):
 def check_subscription_init_callback(call):
     bot.answer_callback_query(call.id)
     msg = bot.send_message(call.message.chat.id, "💳 Enter User ID to check sub.\n/cancel to abort.")
-    bot.register_next_step_handler(msg, process_check_subscription_id)
+    register_prompt(msg, process_check_subscription_id)
 
 def process_check_subscription_id(message):
     admin_id_check = message.from_user.id
     if admin_id_check not in admin_ids:
-        bot.reply_to(message, "⚠️ Not authorized.")
+        bot.reply_to(message, NOT_AUTHORIZED_MSG)
         return
     if message.text.lower() == '/cancel':
         bot.reply_to(message, "Sub check cancelled.")
@@ -2331,57 +2687,110 @@ def process_check_subscription_id(message):
     except ValueError:
         bot.reply_to(message, "⚠️ Invalid ID. Send numerical ID or /cancel.")
         msg = bot.send_message(message.chat.id, "💳 Enter User ID to check, or /cancel.")
-        bot.register_next_step_handler(msg, process_check_subscription_id)
+        register_prompt(msg, process_check_subscription_id)
     except Exception as e:
         logger.error(f"Error processing check sub: {e}", exc_info=True)
         bot.reply_to(message, "Error.")
 
+# --- Callback Dispatch Tables ---
+LOCKED_ALLOWED_CALLBACKS = frozenset({'back_to_main', 'speed', 'stats'})
+
+CALLBACK_DISPATCH = {
+    'upload': upload_callback,
+    'check_files': check_files_callback,
+    'speed': speed_callback,
+    'back_to_main': back_to_main_callback,
+    'cancel_broadcast': handle_cancel_broadcast,
+    'stats': stats_callback,
+    'subscription': lambda call: admin_required_callback(call, subscription_management_callback),
+    'lock_bot': lambda call: admin_required_callback(call, lock_bot_callback),
+    'unlock_bot': lambda call: admin_required_callback(call, unlock_bot_callback),
+    'run_all_scripts': lambda call: admin_required_callback(call, run_all_scripts_callback),
+    'broadcast': lambda call: admin_required_callback(call, broadcast_init_callback),
+    'admin_panel': lambda call: admin_required_callback(call, admin_panel_callback),
+    'add_admin': lambda call: owner_required_callback(call, add_admin_init_callback),
+    'remove_admin': lambda call: owner_required_callback(call, remove_admin_init_callback),
+    'list_admins': lambda call: admin_required_callback(call, list_admins_callback),
+    'add_subscription': lambda call: admin_required_callback(call, add_subscription_init_callback),
+    'remove_subscription': lambda call: admin_required_callback(call, remove_subscription_init_callback),
+    'check_subscription': lambda call: admin_required_callback(call, check_subscription_init_callback),
+}
+
+# Callbacks that carry arguments after a fixed prefix, checked only when there is no exact match
+CALLBACK_PREFIX_DISPATCH = (
+    ('file_', file_control_callback),
+    ('files_page_', files_page_callback),
+    ('start_', start_bot_callback),
+    ('stop_', stop_bot_callback),
+    ('restart_', restart_bot_callback),
+    ('delete_', delete_bot_callback),
+    ('logs_', logs_bot_callback),
+    ('confirm_broadcast_', handle_confirm_broadcast),
+)
+
 # --- Cleanup Function ---
+CLEANUP_TERM_TIMEOUT = 3  # seconds all scripts get to exit after SIGTERM before SIGKILL
+
 def cleanup():
     logger.warning("Shutdown. Cleaning up processes...")
-    script_keys_to_stop = list(bot_scripts.keys())
-    if not script_keys_to_stop:
+    scripts_to_stop = snapshot_scripts()
+    if not scripts_to_stop:
         logger.info("No scripts running. Exiting.")
         return
-    logger.info(f"Stopping {len(script_keys_to_stop)} scripts...")
-    for key in script_keys_to_stop:
-        if key in bot_scripts:
-            logger.info(f"Stopping: {key}")
-            kill_process_tree(bot_scripts[key])
-        else:
-            logger.info(f"Script {key} already removed.")
+    logger.info(f"Stopping {len(scripts_to_stop)} scripts...")
+    # Signal every tree first and wait for all of them at once, so shutdown takes
+    # one grace period instead of one per script (and needs no threads at exit)
+    procs = []
+    for key, script_info in scripts_to_stop:
+        logger.info(f"Stopping: {key}")
+        try:
+            parent = psutil.Process(script_info.process.pid)
+            tree = parent.children(recursive=True) + [parent]
+        except psutil.NoSuchProcess:
+            logger.info(f"Script {key} already gone.")
+            continue
+        finally:
+            close_process_stdin(script_info.process)
+        for proc in tree:
+            with contextlib.suppress(psutil.NoSuchProcess):
+                proc.terminate()
+        procs.extend(tree)
+    _, alive = psutil.wait_procs(procs, timeout=CLEANUP_TERM_TIMEOUT)
+    for proc in alive:
+        logger.warning(f"Process {proc.pid} still alive after SIGTERM. Killing.")
+        with contextlib.suppress(psutil.NoSuchProcess):
+            proc.kill()
+    psutil.wait_procs(alive, timeout=1)
     logger.warning("Cleanup finished.")
 
 atexit.register(cleanup)
 
+def handle_sigterm(signum, frame):
+    """Turn SIGTERM into a normal exit so cleanup() and close_db() still run via atexit"""
+    logger.warning("SIGTERM received. Exiting...")
+    sys.exit(0)
+
+# web.run_app() swaps in its own graceful handler while serving; this one covers startup
+signal.signal(signal.SIGTERM, handle_sigterm)
+
 # --- Main Execution ---
 if __name__ == '__main__':
     logger.info("=" * 40 + "\n🤖 Bot Starting Up...\n" + f"🐍 Python: {3.12}\n" +
                 f"🔧 Base Dir: {BASE_DIR}\n📁 Upload Dir: {UPLOAD_BOTS_DIR}\n" +
                 f"📊 Data Dir: {IROTECH_DIR}\n🔑 Owner ID: {OWNER_ID}\n🛡️ Admins: {admin_ids}\n" + "=" * 40)
     
-    # Use your specific Render URL
-    RENDER_URL = "https://rs-clone-mhzw.onrender.com"
-    WEBHOOK_PATH = "/webhook"
-    
-    # Step 1: Start auto-ping thread (to prevent sleep)
-    auto_ping_thread = threading.Thread(target=auto_ping, daemon=True)
-    auto_ping_thread.start()
-    logger.info("🔄 Auto-ping thread started (prevents 15min sleep)")
+    WEBHOOK_ALLOWED_UPDATES = ['message', 'callback_query']  # the only update types with handlers
     
-    # Step 2: Configure webhook
+    # Step 1: Configure webhook
     try:
         logger.info(f"🌐 Configuring webhook for Render...")
         
-        # Delete old webhook
-        bot.remove_webhook()
-        time.sleep(2)
-        
-        # Set new webhook
+        # setWebhook replaces any existing webhook, so no remove + wait is needed
         webhook_url = f"{RENDER_URL}{WEBHOOK_PATH}"
         logger.info(f"🔄 Setting webhook to: {webhook_url}")
         
-        success = bot.set_webhook(url=webhook_url)
+        success = bot.set_webhook(url=webhook_url, allowed_updates=WEBHOOK_ALLOWED_UPDATES,
+                                  secret_token=WEBHOOK_SECRET)
         if success:
             logger.info("✅ Webhook configured successfully!")
         else:
@@ -2390,11 +2799,15 @@ if __name__ == '__main__':
     except Exception as e:
         logger.error(f"⚠️ Webhook setup error: {e}")
     
-    # Step 3: Start Flask server
+    # Step 2: Start web server (auto-ping runs on the same event loop)
     port = int(os.environ.get("PORT", 8080))
     logger.info(f"🚀 Starting server on port {port}...")
     logger.info(f"🔗 Webhook URL: {RENDER_URL}{WEBHOOK_PATH}")
     logger.info(f"🏓 Ping URL: {RENDER_URL}/ping")
     logger.info(f"📊 Status: {RENDER_URL}/status")
     
-    app.run(host='0.0.0.0', port=port)
+    if uvloop is not None:
+        # run_app() creates its loop through the policy, so this must come first
+        asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+        logger.info("⚡ Using uvloop event loop")
+    web.run_app(app, host='0.0.0.0', port=port, print=logger.info)